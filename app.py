@@ -1,14 +1,21 @@
 import os
+import re
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
 import streamlit as st
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, make_url, text
 import plotly.express as px
 import folium
 from streamlit_folium import st_folium
 
 # Import LangChain components
 from langchain_community.utilities import SQLDatabase
+from langchain_community.utilities.sql_database import truncate_word
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_community.agent_toolkits import create_sql_agent
 from langchain.agents.agent_types import AgentType
@@ -28,11 +35,132 @@ if not os.getenv("DATABASE_URL") or not os.getenv("GOOGLE_API_KEY"):
     st.error("🚨 DATABASE_URL or GOOGLE_API_KEY not found. Please check your .env file.")
     st.stop()
 
+# Connect through psycopg 3
+DB_URL = make_url(os.getenv("DATABASE_URL")).set(drivername="postgresql+psycopg")
+
+# Connections kept open for the app and the agent's SQL tool, plus short-lived extras under load
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+
+# Questions at least this similar to an answered one reuse its answer
+SEMANTIC_CACHE_THRESHOLD = 0.95
+CACHED_ANSWER_NOTE = "♻️ Reused answer from an earlier, similar question."
+# Bounds shared by the query result cache and the answer cache (seconds, entries)
+CACHE_TTL = 600
+CACHE_MAX_ENTRIES = 64
+
+MONTHS = {
+    'january', 'february', 'march', 'april', 'may', 'june', 'july', 'august',
+    'september', 'october', 'november', 'december',
+    'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec'
+}
+
+# Words that flip the meaning of otherwise near-identical questions
+AGGREGATE_WORDS = {
+    'max', 'maximum', 'min', 'minimum', 'highest', 'lowest', 'deepest', 'shallowest',
+    'warmest', 'hottest', 'coldest', 'coolest', 'saltiest', 'freshest', 'largest', 'smallest',
+    'most', 'least', 'avg', 'average', 'mean', 'median', 'sum', 'total', 'count',
+    'first', 'last', 'latest', 'earliest', 'oldest', 'newest'
+}
+COMPARISON_WORDS = {
+    'above', 'below', 'over', 'under', 'greater', 'less', 'more', 'fewer', 'before', 'after',
+    'between', 'increase', 'decrease', 'higher', 'lower', 'deeper', 'shallower', 'warmer', 'colder'
+}
+# Region words users often type in lowercase
+REGION_WORDS = {
+    'arabian', 'bengal', 'andaman', 'laccadive', 'indian', 'pacific', 'atlantic', 'southern', 'arctic',
+    'sea', 'bay', 'gulf', 'ocean', 'equator', 'equatorial', 'tropical', 'north', 'south', 'east', 'west',
+    'northern', 'eastern', 'western'
+}
+ENTITY_WORDS = MONTHS | AGGREGATE_WORDS | COMPARISON_WORDS | REGION_WORDS
+
+# Caps on how much of each agent query result is fed back to the LLM
+AGENT_ROW_LIMIT = 50
+AGENT_RESULT_MAX_CHARS = 4000
+
+class LimitedSQLDatabase(SQLDatabase):
+    """SQLDatabase that limits SELECTs and truncates results before they reach the LLM."""
+
+    def run(self, command, fetch="all", include_columns=False, **kwargs):
+        limited, more_rows = False, False
+        if isinstance(command, str) and fetch == "all":
+            command, limited = limit_select(command)
+        if limited:
+            # The injected LIMIT fetches one extra row so we know whether anything was cut off
+            rows = self._execute(command, fetch, **kwargs)
+            more_rows = len(rows) > AGENT_ROW_LIMIT
+            result = self.format_rows(rows[:AGENT_ROW_LIMIT], include_columns)
+        else:
+            result = super().run(command, fetch, include_columns, **kwargs)
+        if isinstance(result, str):
+            if len(result) > AGENT_RESULT_MAX_CHARS:
+                result = result[:AGENT_RESULT_MAX_CHARS] + f"... (truncated to {AGENT_RESULT_MAX_CHARS} characters)"
+            if more_rows:
+                # Tell the LLM the rows are incomplete so it doesn't present them as the full answer
+                result += f" (limited to {AGENT_ROW_LIMIT} rows)"
+        return result
+
+    def format_rows(self, rows, include_columns):
+        """Formats fetched rows the same way SQLDatabase.run does."""
+        res = [
+            {column: truncate_word(value, length=self._max_string_length) for column, value in row.items()}
+            for row in rows
+        ]
+        if not include_columns:
+            res = [tuple(row.values()) for row in res]
+        return str(res) if res else ""
+
+def strip_sql_comments(query):
+    """Removes -- and /* */ comments from a query, leaving string literals untouched."""
+    return re.sub(r"('(?:[^']|'')*')|--[^\n]*|/\*.*?\*/", lambda m: m.group(1) or " ", query, flags=re.DOTALL)
+
+def top_level_sql(query):
+    """Blanks out string literals and everything inside parentheses, leaving the outermost statement."""
+    query = re.sub(r"'(?:[^']|'')*'", "''", query)
+    depth, chars = 0, []
+    for ch in query:
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        chars.append(ch if depth == 0 and ch != ')' else ' ')
+    return "".join(chars)
+
+def limit_select(query):
+    """Appends a LIMIT to SELECTs whose outermost statement has none. Returns (query, limit_added)."""
+    stripped = strip_sql_comments(query).strip().rstrip(';').rstrip()
+    if not re.match(r"(select|with)\b", stripped, re.IGNORECASE):
+        return query, False
+    # A LIMIT/FETCH inside a subquery doesn't cap the outer result; a WITH ... INSERT can't take one
+    if re.search(r"\b(limit|fetch|insert|update|delete)\b", top_level_sql(stripped), re.IGNORECASE):
+        return query, False
+    return f"{stripped} LIMIT {AGENT_ROW_LIMIT + 1}", True
+
 # Cache the engine and agent creation so it doesn't run on every interaction
 @st.cache_resource
 def get_db_engine_and_agent():
-    engine = create_engine(os.getenv("DATABASE_URL"))
-    db = SQLDatabase(engine=engine)
+    # The pool is shared by every session and the agent's concurrent tool calls
+    engine = create_engine(
+        DB_URL,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=False,
+        pool_recycle=3600,
+        connect_args={"prepare_threshold": 0}
+    )
+    # Pre-warm the pool so the first queries skip the connect/auth handshake
+    connections = []
+    try:
+        for _ in range(DB_POOL_SIZE):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+    # The agent's ad-hoc queries use server-side cursors, so a large result is fetched in
+    # buffered chunks. The app's small, repeated queries stay on client-side cursors, which
+    # psycopg can prepare. Keep the schema preamble sent to the LLM short.
+    agent_engine = engine.execution_options(stream_results=True, max_row_buffer=10_000)
+    db = LimitedSQLDatabase(engine=agent_engine, sample_rows_in_table_info=2, max_string_length=200)
     llm = ChatGoogleGenerativeAI(model="gemini-1.5-pro-latest", temperature=0, convert_system_message_to_human=True)
     agent_executor = create_sql_agent(
         llm,
@@ -46,22 +174,158 @@ def get_db_engine_and_agent():
 engine, agent_executor = get_db_engine_and_agent()
 
 # --- HELPER FUNCTIONS ---
-@st.cache_data
-def run_query(query):
-    """Runs a SQL query and returns a DataFrame."""
+# Bounded, expiring result caches so distinct map drags can't grow memory without limit
+@st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def run_query(query, params=None):
+    """Runs a parameterized SQL query and returns a DataFrame."""
     with engine.connect() as connection:
-        df = pd.read_sql(text(query), connection)
+        df = pd.read_sql(text(query), connection, params=params, dtype_backend="pyarrow")
     return df
 
-def create_profile_plot(df, y_axis='pressure'):
-    """Intelligently creates a plot based on available columns."""
-    columns = [col for col in df.columns if col not in ['id', 'float_id', 'timestamp', 'latitude', 'longitude', 'location', 'pressure']]
-    if not columns:
-        st.warning("No plottable data columns found in the query result.")
+@st.cache_resource
+def get_event_loop():
+    """One event loop on a daemon thread, shared by every agent run."""
+    # The LLM's async grpc client binds to the loop it is first used on, so the loop must outlive each question
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+async def next_event(events):
+    """Returns the next event from an async event stream, or None when it is exhausted."""
+    try:
+        return await events.__anext__()
+    except StopAsyncIteration:
+        return None
+
+def stream_agent_answer(full_prompt, placeholder):
+    """Runs the SQL agent, streaming its final answer into placeholder, and returns the agent's output."""
+    # Streamlit runs the script synchronously, so drive the async event stream on the shared loop.
+    # On the async path AgentExecutor gathers all tool calls from one step concurrently.
+    loop = get_event_loop()
+    events = agent_executor.astream_events({"input": full_prompt}, version="v2")
+    # Streamed tokens are for live display only; the answer is the agent's own output
+    answer, output = "", ""
+    try:
+        while (event := asyncio.run_coroutine_threadsafe(next_event(events), loop).result()) is not None:
+            kind = event["event"]
+            if kind in ("on_chat_model_start", "on_tool_start"):
+                # Only the last model turn is the answer; text from earlier turns is discarded
+                answer = ""
+                placeholder.empty()
+            elif kind == "on_chat_model_stream":
+                chunk = event["data"]["chunk"]
+                if chunk.tool_call_chunks:
+                    # This turn calls a tool, so any text it wrote is reasoning, not the answer
+                    answer = ""
+                    placeholder.empty()
+                elif isinstance(chunk.content, str) and chunk.content:
+                    answer += chunk.content
+                    placeholder.markdown(answer)
+            elif kind == "on_chain_end" and not event.get("parent_ids"):
+                # The top-level AgentExecutor run, including messages that are never streamed
+                # such as the iteration-limit stop
+                output = event["data"]["output"]["output"]
+    finally:
+        asyncio.run_coroutine_threadsafe(events.aclose(), loop).result()
+    if output != answer:
+        placeholder.markdown(output)
+    return output
+
+@st.cache_resource
+def get_embedder():
+    # Imported here so torch only loads once the chat tab actually needs embeddings
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer("all-MiniLM-L6-v2")
+
+@st.cache_resource
+def get_answer_cache():
+    """Answers shared across sessions, keyed by normalized question, oldest first."""
+    return {"lock": threading.Lock(), "entries": OrderedDict(), "data_version": None}
+
+def normalize_prompt(prompt):
+    """Lowercases a question and strips punctuation and extra whitespace."""
+    return " ".join(re.sub(r"[^\w\s]", " ", prompt.lower()).split())
+
+def prompt_entities(prompt):
+    """Numbers, IDs, capitalized names and ENTITY_WORDS in a question; these must match exactly for a cache hit."""
+    words = re.findall(r"\w+", prompt)
+    entities = set()
+    for i, word in enumerate(words):
+        lower = word.lower()
+        if any(c.isdigit() for c in word) or lower in ENTITY_WORDS or (i > 0 and word[0].isupper()):
+            entities.add(lower)
+    return frozenset(entities)
+
+def get_data_version():
+    """Returns a marker that changes whenever new measurements are ingested."""
+    with engine.connect() as connection:
+        return connection.execute(text("SELECT max(id) FROM argo_measurements")).scalar()
+
+def sync_answer_cache(cache, data_version):
+    """Drops answers that are stale because of new data or age. Call with the cache lock held."""
+    if cache["data_version"] != data_version:
+        cache["entries"].clear()
+        cache["data_version"] = data_version
+    cutoff = time.monotonic() - CACHE_TTL
+    for key in [key for key, entry in cache["entries"].items() if entry["stored_at"] < cutoff]:
+        del cache["entries"][key]
+
+def lookup_cached_answer(prompt, data_version):
+    """Returns a cached answer for the same or a semantically similar question, or None."""
+    cache = get_answer_cache()
+    key = normalize_prompt(prompt)
+    entities = prompt_entities(prompt)
+    with cache["lock"]:
+        sync_answer_cache(cache, data_version)
+        if key in cache["entries"]:
+            return cache["entries"][key]["answer"]
+        # Similar wording is only good enough when the float IDs, dates and places are identical
+        candidates = [entry for entry in cache["entries"].values() if entry["entities"] == entities]
+    if not candidates:
         return None
 
-    x_axis = st.selectbox("Select a variable to plot against Pressure", options=columns)
-    if x_axis:
+    # Embeddings are unit length, so the dot product is the cosine similarity
+    embeddings = np.vstack([entry["embedding"] for entry in candidates])
+    similarities = embeddings @ get_embedder().encode(key, normalize_embeddings=True)
+    best = int(np.argmax(similarities))
+    if similarities[best] >= SEMANTIC_CACHE_THRESHOLD:
+        return candidates[best]["answer"]
+    return None
+
+def store_cached_answer(prompt, answer, data_version):
+    if not answer or not answer.strip():
+        return
+    cache = get_answer_cache()
+    key = normalize_prompt(prompt)
+    entry = {
+        "answer": answer,
+        "embedding": get_embedder().encode(key, normalize_embeddings=True),
+        "entities": prompt_entities(prompt),
+        "stored_at": time.monotonic()
+    }
+    with cache["lock"]:
+        sync_answer_cache(cache, data_version)
+        cache["entries"].pop(key, None)
+        cache["entries"][key] = entry
+        while len(cache["entries"]) > CACHE_MAX_ENTRIES:
+            cache["entries"].popitem(last=False)
+
+@st.cache_resource
+def build_base_map():
+    """Builds the explorer map once instead of on every rerun."""
+    # Initialize map centered on the Indian Ocean
+    m = folium.Map(location=[0, 80], zoom_start=3)
+
+    # Add a drawing tool to the map
+    folium.plugins.Draw(
+        export=False,
+        draw_options={'polyline': False, 'polygon': False, 'circle': False, 'marker': False, 'circlemarker': False}
+    ).add_to(m)
+    return m
+
+def create_profile_plot(df, x_axis, y_axis='pressure'):
+    """Creates a profile plot of the selected variable against pressure."""
+    if x_axis in df.columns:
         title = f"{x_axis.replace('_', ' ').title()} vs. Pressure"
         labels = {x_axis: x_axis.title(), y_axis: 'Pressure (dbar)'}
         fig = px.line(df, x=x_axis, y=y_axis, title=title, labels=labels)
@@ -69,6 +333,9 @@ def create_profile_plot(df, y_axis='pressure'):
         return fig
     return None
 
+# Measurement columns that can be plotted against pressure
+PLOTTABLE_COLUMNS = ['temperature', 'salinity']
+
 # --- MAIN APPLICATION UI ---
 st.title("🌊 FloatChat - ARGO Float Data Explorer")
 
@@ -85,6 +352,8 @@ with tab1:
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
+            if message.get("cached"):
+                st.caption(CACHED_ANSWER_NOTE)
 
     if prompt := st.chat_input("e.g., What is the max temperature?"):
         st.session_state.messages.append({"role": "user", "content": prompt})
@@ -97,13 +366,21 @@ with tab1:
                     full_prompt = (
                         f"You are an expert oceanographer's assistant. Based on the user's question, "
                         f"First, think about what you need to do. Then, write and execute a SQL query to get the necessary data. "
+                        f"If the question needs several independent queries (e.g. comparing two regions), "
+                        f"call the query tool for all of them in the same step instead of one after another. "
                         f"Finally, answer the user's question based on the query results. "
                         f"Question: '{prompt}'"
                     )
-                    response = agent_executor.invoke({"input": full_prompt})
-                    response_output = response["output"]
-                    st.markdown(response_output)
-                    st.session_state.messages.append({"role": "assistant", "content": response_output})
+                    data_version = get_data_version()
+                    response_output = lookup_cached_answer(prompt, data_version)
+                    cached = response_output is not None
+                    if cached:
+                        st.markdown(response_output)
+                        st.caption(CACHED_ANSWER_NOTE)
+                    else:
+                        response_output = stream_agent_answer(full_prompt, st.empty())
+                        store_cached_answer(prompt, response_output, data_version)
+                    st.session_state.messages.append({"role": "assistant", "content": response_output, "cached": cached})
                 except Exception as e:
                     error_message = f"An error occurred: {e}"
                     st.error(error_message)
@@ -113,58 +390,61 @@ with tab1:
 with tab2:
     st.header("Select a Region on the Map to Find Floats")
     
-    # Initialize map centered on the Indian Ocean
-    m = folium.Map(location=[0, 80], zoom_start=3)
-
-    # Add a drawing tool to the map
-    folium.plugins.Draw(
-        export=False,
-        draw_options={'polyline': False, 'polygon': False, 'circle': False, 'marker': False, 'circlemarker': False}
-    ).add_to(m)
+    m = build_base_map()
 
     st.info("Use the rectangle tool on the map's left side to draw a box over an area of interest.")
 
-    # Render the map and capture the drawing events
-    map_data = st_folium(m, width='100%', height=500)
+    # Render the map and capture the drawing events. The fixed key keeps the widget state across
+    # reruns, and only the last drawing is sent back to the server.
+    map_data = st_folium(m, width='100%', height=500, key="argo_map", returned_objects=["last_active_drawing"])
 
     # Check if a rectangle was drawn
     if map_data.get("last_active_drawing"):
         bounds = map_data["last_active_drawing"]["geometry"]["coordinates"][0]
-        min_lon, min_lat = bounds[0]
-        max_lon, max_lat = bounds[2]
+        # Round to 3 decimals (~100 m) so nearly identical rectangles share a cache entry
+        min_lon, min_lat = (round(v, 3) for v in bounds[0])
+        max_lon, max_lat = (round(v, 3) for v in bounds[2])
 
         st.subheader("Query Results")
         with st.spinner("Finding floats in the selected area..."):
-            # Construct the PostGIS query
-            query = f"""
-            SELECT DISTINCT float_id, latitude, longitude, timestamp
-            FROM argo_measurements
-            WHERE ST_Intersects(
-                location,
-                ST_MakeEnvelope({min_lon}, {min_lat}, {max_lon}, {max_lat}, 4326)
+            # Construct the PostGIS query. The envelope is built once in a CTE, and the
+            # index-only && bounding-box test culls rows before the exact ST_Intersects check.
+            query = """
+            WITH bbox AS (
+                SELECT ST_MakeEnvelope(:min_lon, :min_lat, :max_lon, :max_lat, 4326) AS geom
             )
-            ORDER BY timestamp DESC;
+            SELECT DISTINCT float_id, latitude, longitude, timestamp
+            FROM argo_measurements, bbox
+            WHERE location && bbox.geom
+              AND ST_Intersects(location, bbox.geom)
+            ORDER BY timestamp DESC
             """
             
             try:
-                result_df = run_query(query)
+                envelope = {'min_lon': min_lon, 'min_lat': min_lat, 'max_lon': max_lon, 'max_lat': max_lat}
+                result_df = run_query(query, envelope)
                 
                 if not result_df.empty:
                     # Display metrics
                     col1, col2 = st.columns(2)
-                    col1.metric("Floats Found", result_df['float_id'].nunique())
+                    # One pass for the distinct floats, reused by the metric and the selectbox
+                    unique_floats = result_df['float_id'].unique()
+                    col1.metric("Floats Found", len(unique_floats))
                     col2.metric("Total Measurements", len(result_df))
                     
                     # Display the data table
                     st.dataframe(result_df)
 
                     # Allow user to select a float to plot
-                    selected_float = st.selectbox("Select a Float ID to plot its full profile", options=result_df['float_id'].unique())
-                    if selected_float:
-                        profile_query = f"SELECT * FROM argo_measurements WHERE float_id = '{selected_float}';"
-                        profile_df = run_query(profile_query)
-                        
-                        plot_fig = create_profile_plot(profile_df)
+                    selected_float = st.selectbox("Select a Float ID to plot its full profile", options=unique_floats)
+                    x_axis = st.selectbox("Select a variable to plot against Pressure", options=PLOTTABLE_COLUMNS)
+                    # Column names can't be bound, so x_axis must come from the whitelist
+                    if selected_float and x_axis in PLOTTABLE_COLUMNS:
+                        # Only fetch the two plotted columns; the float ID is a bound parameter
+                        profile_query = "SELECT pressure, " + x_axis + " FROM argo_measurements WHERE float_id = :fid"
+                        profile_df = run_query(profile_query, {'fid': selected_float})
+
+                        plot_fig = create_profile_plot(profile_df, x_axis)
                         if plot_fig:
                             st.plotly_chart(plot_fig, use_container_width=True)
 
@@ -1,9 +1,12 @@
 import os
+import io
+import glob
+import numpy as np
 import pandas as pd
 import xarray as xr
 from dotenv import load_dotenv
-from sqlalchemy import (create_engine, inspect, MetaData, Table, Column, 
-                        Integer, Float, DateTime, String)
+from sqlalchemy import (create_engine, inspect, text, MetaData, Table, Column, 
+                        Integer, Float, DateTime, String, Computed)
 from geoalchemy2.types import Geometry # type: ignore
 import warnings
 
@@ -20,6 +23,8 @@ engine = create_engine(db_url)
 metadata = MetaData()
 
 # --- 2. DEFINE THE DATABASE TABLE STRUCTURE ---
+LOCATION_EXPR = "ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)"
+
 argo_table = Table('argo_measurements', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
     Column('float_id', String(20)),
@@ -29,9 +34,45 @@ argo_table = Table('argo_measurements', metadata,
     Column('pressure', Float),
     Column('temperature', Float),
     Column('salinity', Float),
-    Column('location', Geometry('POINT', srid=4326)) # For geospatial queries
+    # For geospatial queries. Postgres computes the point from longitude/latitude on insert.
+    Column('location', Geometry('POINT', srid=4326), Computed(LOCATION_EXPR, persisted=True))
 )
 
+def migrate_location_column(engine):
+    """Turns a plain location column from older tables into the generated column."""
+    with engine.begin() as connection:
+        is_generated = connection.execute(text(
+            "SELECT is_generated FROM information_schema.columns "
+            "WHERE table_name = 'argo_measurements' AND column_name = 'location'"
+        )).scalar()
+        if is_generated == 'ALWAYS':
+            return
+        print("Converting 'location' to a generated column...")
+        connection.execute(text("ALTER TABLE argo_measurements DROP COLUMN IF EXISTS location"))
+        connection.execute(text(
+            "ALTER TABLE argo_measurements ADD COLUMN location geometry(POINT, 4326) "
+            f"GENERATED ALWAYS AS ({LOCATION_EXPR}) STORED"
+        ))
+
+# Spatial index for the map tab; same name GeoAlchemy uses, so it is never duplicated
+SPATIAL_INDEX = 'idx_argo_measurements_location'
+SPATIAL_INDEX_DDL = f"CREATE INDEX IF NOT EXISTS {SPATIAL_INDEX} ON argo_measurements USING GIST (location)"
+
+# Indexes for the app's queries
+INDEX_DDL = [
+    SPATIAL_INDEX_DDL,
+    # Profile lookups and the map tab's ORDER BY timestamp
+    "CREATE INDEX IF NOT EXISTS argo_float_ts_idx ON argo_measurements (float_id, timestamp DESC)",
+    # Covering index so the profile query can be answered index-only
+    "CREATE INDEX IF NOT EXISTS argo_float_profile_idx ON argo_measurements (float_id) "
+    "INCLUDE (pressure, temperature, salinity)",
+]
+
+def create_indexes(engine):
+    with engine.begin() as connection:
+        for ddl in INDEX_DDL:
+            connection.execute(text(ddl))
+
 # --- 3. PARSE THE NETCDF FILE ---
 def parse_argo_file(file_path):
     print(f"Opening NetCDF file: {file_path}")
@@ -40,30 +81,35 @@ def parse_argo_file(file_path):
             # Extract the platform number (float ID)
             platform_number = ds.PLATFORM_NUMBER.values[0].decode('utf-8').strip()
             
-            # Convert to a pandas DataFrame for easier handling
-            df = ds.to_dataframe().reset_index()
-            
-            # Select and rename columns for clarity
-            core_data = df[[
-                'JULD', 'LATITUDE', 'LONGITUDE', 
-                'PRES_ADJUSTED', 'TEMP_ADJUSTED', 'PSAL_ADJUSTED'
-            ]].copy()
-            core_data.rename(columns={
-                'JULD': 'timestamp',
-                'LATITUDE': 'latitude',
-                'LONGITUDE': 'longitude',
-                'PRES_ADJUSTED': 'pressure',
-                'TEMP_ADJUSTED': 'temperature',
-                'PSAL_ADJUSTED': 'salinity'
-            }, inplace=True)
+            # Flatten the (N_PROF, N_LEVELS) measurements and repeat the per-profile
+            # time/position across levels, instead of materializing every dimension
+            n_levels = ds.sizes['N_LEVELS']
+            pressure = ds.PRES_ADJUSTED.values.ravel()
+            temperature = ds.TEMP_ADJUSTED.values.ravel()
+            salinity = ds.PSAL_ADJUSTED.values.ravel()
+
+            juld = ds.JULD.values
+            latitude = ds.LATITUDE.values
+            longitude = ds.LONGITUDE.values
+
+            # Drop rows with any missing values with one combined mask, before building the
+            # DataFrame. Time/position are checked once per profile and repeated across levels.
+            profile_valid = ~np.isnat(juld) & np.isfinite(latitude) & np.isfinite(longitude)
+            valid = (np.isfinite(pressure) & np.isfinite(temperature) & np.isfinite(salinity)
+                     & np.repeat(profile_valid, n_levels))
+
+            core_data = pd.DataFrame({
+                'timestamp': np.repeat(juld, n_levels)[valid],
+                'latitude': np.repeat(latitude, n_levels)[valid],
+                'longitude': np.repeat(longitude, n_levels)[valid],
+                'pressure': pressure[valid],
+                'temperature': temperature[valid],
+                'salinity': salinity[valid]
+            })
 
-            
             # Add the float ID to each row
             core_data['float_id'] = platform_number
 
-            # Drop rows with any missing measurements
-            core_data.dropna(inplace=True)
-            
             print(f"Successfully parsed {len(core_data)} measurements for float {platform_number}")
             return core_data
 
@@ -71,7 +117,104 @@ def parse_argo_file(file_path):
         print(f"Error parsing file {file_path}: {e}")
         return None
 
-# --- 4. MAIN EXECUTION LOGIC ---
+# --- 4. BULK LOAD WITH COPY ---
+# location is a generated column, so only the numeric columns are sent
+COPY_COLUMNS = ['float_id', 'timestamp', 'latitude', 'longitude',
+                'pressure', 'temperature', 'salinity']
+
+def copy_measurements(connection, df):
+    """Streams a DataFrame into argo_measurements using Postgres COPY."""
+    buf = io.StringIO()
+    df[COPY_COLUMNS].to_csv(buf, index=False, header=False)
+    buf.seek(0)
+
+    # Reuse the DBAPI connection so the COPY runs inside the caller's transaction
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY argo_measurements ({','.join(COPY_COLUMNS)}) FROM STDIN WITH CSV",
+            buf
+        )
+    finally:
+        cursor.close()
+
+# --- 5. MULTI-FILE INGESTION ---
+DATA_DIR = 'data'
+# Rows to accumulate across files before issuing one COPY
+CHUNK_ROWS = 1_000_000
+# Only drop and rebuild the GIST index when a load adds at least this fraction of the table
+SPATIAL_INDEX_REBUILD_FRACTION = 0.2
+
+def profile_key(argo_data):
+    """Identifies a profile by its float ID and first timestamp."""
+    return (argo_data['float_id'].iloc[0], argo_data['timestamp'].min())
+
+def profile_exists(connection, key):
+    """Checks whether the profile with this (float_id, first timestamp) key is already loaded."""
+    float_id, first_timestamp = key
+    result = connection.execute(
+        text("SELECT EXISTS (SELECT 1 FROM argo_measurements WHERE float_id = :fid AND timestamp = :ts)"),
+        {'fid': float_id, 'ts': first_timestamp}
+    ).scalar()
+    return result
+
+def estimated_row_count(connection):
+    """Returns the planner's row estimate for argo_measurements (0 if never analyzed)."""
+    reltuples = connection.execute(
+        text("SELECT reltuples FROM pg_class WHERE oid = 'argo_measurements'::regclass")
+    ).scalar()
+    return max(reltuples or 0, 0)
+
+def ingest_files(connection, file_paths):
+    """Parses NetCDF files and COPYs them in chunks of ~CHUNK_ROWS rows. Returns rows inserted."""
+    # Skip waiting for the WAL flush; if a crash loses the commit, re-running the ingest reloads it
+    connection.execute(text("SET LOCAL synchronous_commit = off"))
+
+    pending, pending_rows, inserted = [], 0, 0
+    spatial_index_checked, spatial_index_dropped = False, False
+    # Keys of every profile queued in this run. Rows still in `pending` aren't in the table yet,
+    # so profile_exists can't see e.g. the R and D files of one cycle.
+    queued_profiles = set()
+
+    def flush():
+        nonlocal pending, pending_rows, inserted, spatial_index_checked, spatial_index_dropped
+        if not pending:
+            return
+        if not spatial_index_checked:
+            spatial_index_checked = True
+            # Building the GIST index once after a big load is much faster than updating it per row,
+            # but the DROP locks the table until commit and the rebuild covers every existing row.
+            # Small appends COPY with the index in place.
+            if pending_rows >= SPATIAL_INDEX_REBUILD_FRACTION * estimated_row_count(connection):
+                connection.execute(text(f"DROP INDEX IF EXISTS {SPATIAL_INDEX}"))
+                spatial_index_dropped = True
+        print(f"Inserting {pending_rows} new records into the database...")
+        copy_measurements(connection, pd.concat(pending, ignore_index=True))
+        inserted += pending_rows
+        pending, pending_rows = [], 0
+
+    for file_path in file_paths:
+        argo_data = parse_argo_file(file_path)
+        if argo_data is None or argo_data.empty:
+            continue
+        key = profile_key(argo_data)
+        if key in queued_profiles or profile_exists(connection, key):
+            print(f"Data for float {key[0]} from this profile already exists. Skipping insertion.")
+            continue
+
+        queued_profiles.add(key)
+        pending.append(argo_data)
+        pending_rows += len(argo_data)
+        if pending_rows >= CHUNK_ROWS:
+            flush()
+    flush()
+
+    if spatial_index_dropped:
+        print("Rebuilding spatial index...")
+        connection.execute(text(SPATIAL_INDEX_DDL))
+    return inserted
+
+# --- 6. MAIN EXECUTION LOGIC ---
 if __name__ == "__main__":
     try:
         # Check if the table exists, and create it if it doesn't
@@ -82,39 +225,24 @@ if __name__ == "__main__":
             print("Table created successfully.")
         else:
             print("Table 'argo_measurements' already exists.")
+            migrate_location_column(engine)
 
-        # Parse the data file
-        file_path = os.path.join('data', 'R2902347_001.nc')
-        argo_data = parse_argo_file(file_path)
+        # Make sure the query indexes exist, including on tables created before they were added
+        create_indexes(engine)
+
+        # Parse and load every NetCDF file in the data directory
+        file_paths = sorted(glob.glob(os.path.join(DATA_DIR, '*.nc')))
+        print(f"Found {len(file_paths)} NetCDF files in '{DATA_DIR}'")
+
+        with engine.connect() as connection:
+            # Begin a transaction
+            with connection.begin() as transaction:
+                inserted = ingest_files(connection, file_paths)
+
+        if inserted:
+            print(f"✅ Data insertion complete. {inserted} records inserted.")
+        else:
+            print("No new records to insert.")
 
-        if argo_data is not None and not argo_data.empty:
-            with engine.connect() as connection:
-                # Begin a transaction
-                with connection.begin() as transaction:
-                    # Check for existing data from this float and timestamp
-                    first_timestamp = argo_data['timestamp'].min()
-                    float_id = argo_data['float_id'].iloc[0]
-                    
-                    from sqlalchemy import text
-                    result = connection.execute(
-                        text("SELECT COUNT(*) FROM argo_measurements WHERE float_id = :fid AND timestamp >= :ts"),
-                        {'fid': float_id, 'ts': first_timestamp}
-                    ).scalar()
-
-                    if result > 0:
-                        print(f"Data for float {float_id} from this profile already exists. Skipping insertion.")
-                    else:
-                        print(f"Inserting {len(argo_data)} new records into the database...")
-                        # Prepare data for insertion, including the PostGIS location point
-                        records_to_insert = []
-                        for index, row in argo_data.iterrows():
-                            record = row.to_dict()
-                            record['location'] = f"POINT({row['longitude']} {row['latitude']})"
-                            records_to_insert.append(record)
-                        
-                        # Use the Core API for efficient bulk insertion
-                        connection.execute(argo_table.insert(), records_to_insert)
-                        print("✅ Data insertion complete.")
-                
     except Exception as e:
-        print(f"An error occurred during the ingestion process: {e}")
\ No newline at end of file
+        print(f"An error occurred during the ingestion process: {e}")